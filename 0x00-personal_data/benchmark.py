@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""A module for benchmarking the personal data helpers.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from threading import Thread
+from typing import Callable, Iterable, Iterator, List
+
+filtered_logger = __import__('filtered_logger')
+encrypt_password = __import__('encrypt_password')
+
+
+MESSAGE = "name=Bob;email=bob@dylan.com;ssn=000-123-0000;password=bobby2019;"
+LINES = 100000
+COLUMNS = "name,email,phone,ssn,password,ip,last_login,user_agent".split(',')
+SCALES = (1000, 100000, 1000000)
+SAMPLE_ROWS = 1000
+ALLOCATION_ROWS = 1000
+BASELINE_FILE = "benchmark_baseline.json"
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/74.0.3729.157 Safari/537.36",
+    "Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; WOW64; "
+    "Trident/5.0; KTXN)",
+    "Mozilla/5.0 (Linux; U; Android 4.1.2; de-de; GT-I9100 Build/JZO54K) "
+    "AppleWebKit/534.30 (KHTML, like Gecko) Version/4.0 Mobile "
+    "Safari/534.30",
+)
+
+
+def per_line(func: Callable[[], object], number: int = LINES) -> float:
+    """Measures the average cost of a call in microseconds.
+    """
+    return timeit.timeit(func, number=number) / number * 1e6
+
+
+def legacy_filter_datum(fields, redaction, message, separator) -> str:
+    """Filters a log line by rebuilding the pattern on every call.
+    """
+    extract = filtered_logger.patterns["extract"]
+    replace = filtered_logger.patterns["replace"]
+    return re.sub(extract(fields, separator), replace(redaction), message)
+
+
+def bench_filter_datum():
+    """Compares the per-line cost of the redaction implementations.
+    """
+    fields = filtered_logger.PII_FIELDS
+    args = (fields, "***", MESSAGE, ";")
+    redactor = filtered_logger.get_redactor(fields, "***", ";")
+    batch = [MESSAGE] * LINES
+    results = {
+        'legacy': per_line(lambda: legacy_filter_datum(*args)),
+        'filter_datum': per_line(lambda: filtered_logger.filter_datum(*args)),
+        'redactor': per_line(lambda: redactor.filter(MESSAGE)),
+        'filter_many': per_line(lambda: redactor.filter_many(batch), 1)
+        / LINES,
+    }
+    for name, cost in results.items():
+        print("{:<16} {:8.3f} us/line".format(name, cost))
+
+
+def random_message(fields: List[str], size: int, rng: random.Random) -> str:
+    """Generates a separated key=value message with some noise.
+    """
+    alphabet = string.ascii_letters + "=; @.-"
+    keys = list(fields) + ['ip', 'user_agent', 'x' + fields[0], '']
+    parts = []
+    for _ in range(size):
+        key = rng.choice(keys)
+        value = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 8)))
+        parts.append('{}{}={}'.format(rng.choice(('', ' ')), key, value))
+    return ';'.join(parts) + rng.choice(('', ';'))
+
+
+def check_backends(samples: int = 20000):
+    """Checks that the other backends match the regex backend.
+    """
+    rng = random.Random(0)
+    for _ in range(samples):
+        count = rng.randint(1, 6)
+        fields = [
+            ''.join(rng.choice('abcde') for _ in range(rng.randint(1, 4)))
+            for _ in range(count)
+        ]
+        message = random_message(fields, rng.randint(0, 12), rng)
+        expected = filtered_logger.filter_datum(fields, "***", message, ";")
+        for backend in ('scan', 'trie'):
+            redactor = filtered_logger.get_redactor(
+                fields, "***", ";", backend,
+            )
+            if redactor.filter(message) != expected:
+                raise AssertionError("{} mismatch for {!r} on {!r}".format(
+                    backend, fields, message,
+                ))
+    print("backends agree on {} random messages".format(samples))
+    for _ in range(samples):
+        fields = rng.sample(filtered_logger.PII_FIELDS, rng.randint(1, 3))
+        keys = list(fields) + ['ip', 'user_' + fields[0], fields[0] + 'x',
+                               'first_' + fields[-1]]
+        row = {
+            rng.choice(keys): ''.join(
+                rng.choice(string.ascii_letters + "=; @.-")
+                for _ in range(rng.randint(0, 8))
+            )
+            for _ in range(rng.randint(1, 6))
+        }
+        plain = '{};'.format('; '.join(
+            '{}={}'.format(key, value) for key, value in row.items()
+        ))
+        expected = filtered_logger.filter_datum(fields, "***", plain, ";")
+        for backend in filtered_logger.REDACTORS:
+            redactor = filtered_logger.get_redactor(
+                fields, "***", ";", backend,
+            )
+            rendered = filtered_logger.RowMessage(row).render(redactor)
+            if rendered != expected:
+                raise AssertionError("{} row mismatch for {!r} on {!r}"
+                                     .format(backend, fields, row))
+    print("row rendering agrees on {} random rows".format(samples))
+
+
+def bench_backends():
+    """Compares the redaction backends across message lengths
+    and field counts.
+    """
+    print("{:>7} {:>7} {:>10} {:>10}".format(
+        'fields', 'pairs', 'regex', 'scan',
+    ))
+    for count in (5, 50, 500):
+        fields = ['field{}'.format(i) for i in range(count)]
+        for size in (8, 64, 512):
+            message = '; '.join(
+                'key{}=value {}'.format(i, i) if i % 2 else
+                'field{}=secret {}'.format(i % count, i)
+                for i in range(size)
+            ) + ';'
+            number = max(LINES // (size * 10), 10)
+            costs = [
+                per_line(
+                    lambda r=filtered_logger.get_redactor(
+                        fields, "***", ";", backend,
+                    ): r.filter(message),
+                    number,
+                )
+                for backend in ('regex', 'scan')
+            ]
+            print("{:>7} {:>7} {:>10.2f} {:>10.2f}".format(
+                count, size, *costs,
+            ))
+
+
+def bench_field_counts(lines: int = 5000):
+    """Compares the redaction backends on user rows as the list of
+    fields grows.
+    """
+    rng = random.Random(2)
+    rows = synthetic_rows(100)
+    messages = list(filtered_logger.format_rows(COLUMNS, rows))
+    extra = [
+        ''.join(rng.choice(string.ascii_lowercase)
+                for _ in range(rng.randint(3, 12)))
+        for _ in range(1000)
+    ]
+    print("{:>7} {:>10} {:>10} {:>10}".format(
+        'fields', 'regex', 'scan', 'trie',
+    ))
+    for count in (5, 10, 50, 100, 500, 1000):
+        fields = list(filtered_logger.PII_FIELDS) + extra[:count - 5]
+        costs = []
+        for backend in ('regex', 'scan', 'trie'):
+            redactor = filtered_logger.get_redactor(
+                fields, "***", ";", backend,
+            )
+            costs.append(per_line(
+                lambda: redactor.filter_many(messages), lines // 100,
+            ) / len(messages))
+        print("{:>7} {:>10.2f} {:>10.2f} {:>10.2f}".format(count, *costs))
+
+
+class UncachedFormatter(filtered_logger.RedactingFormatter):
+    """A redacting formatter rendering the time of every record.
+    """
+    formatTime = logging.Formatter.formatTime
+
+
+def bench_timestamps(records: int = 50000):
+    """Compares record formatting with and without the cached
+    timestamp and the compiled template, at one instant per second
+    and at many records per second.
+    """
+    fields = filtered_logger.PII_FIELDS
+    formatters = {
+        'uncached': UncachedFormatter(fields),
+        'cached': filtered_logger.RedactingFormatter(fields),
+        'compiled': filtered_logger.RedactingFormatter(fields, compiled=True),
+    }
+    rows = synthetic_rows(100)
+    for rate, step in (('1/s', 1.0), ('1M/s', 1e-6)):
+        batch = list(filtered_logger.make_row_records(COLUMNS, rows))
+        for i, record in enumerate(batch):
+            record.created = 1573712064.0 + i * step
+            record.msecs = (record.created - int(record.created)) * 1000
+        costs = [
+            per_line(lambda: list(map(formatter.format, batch)),
+                     records // len(batch)) / len(batch)
+            for formatter in formatters.values()
+        ]
+        print("{:>6} ".format(rate) + ' '.join(
+            "{} {:6.2f} us".format(name, cost)
+            for name, cost in zip(formatters, costs)
+        ))
+
+
+def bench_export_profiles(count: int = 50000):
+    """Compares the bytes fetched and rows/sec of the export profiles
+    against a local SQLite users table.
+    """
+    connection = sqlite3.connect(':memory:')
+    connection.execute("CREATE TABLE users ({});".format(','.join(COLUMNS)))
+    connection.executemany(
+        "INSERT INTO users VALUES ({});".format(','.join('?' * len(COLUMNS))),
+        cycle(synthetic_rows(SAMPLE_ROWS), count),
+    )
+    formatter = filtered_logger.RedactingFormatter(filtered_logger.PII_FIELDS)
+    for profile in filtered_logger.EXPORT_PROFILES:
+        columns, query = filtered_logger.export_query(profile)
+        fetched = 0
+        start = time.perf_counter()
+        cursor = connection.execute(query)
+        for rows in filtered_logger.fetch_batches(cursor):
+            fetched += sum(len(str(x)) for row in rows for x in row)
+            for record in filtered_logger.make_row_records(columns, rows):
+                formatter.format(record)
+        elapsed = time.perf_counter() - start
+        print("{:<10} {:>10.1f} MB fetched {:>10.0f} rows/s".format(
+            profile, fetched / 1e6, count / elapsed,
+        ))
+
+
+def check_incremental(count: int = 20, batch_size: int = 3):
+    """Checks that incremental exports of every profile against a
+    SQLite stand-in log each row exactly once across runs, with
+    several rows sharing a last login and some without one.
+    """
+    rng = random.Random(0)
+
+    def row(i: int, last_login: str) -> tuple:
+        return ("name", "e{:02d}@x.com".format(i * 5 % 97), "phone", "ssn",
+                "pwd", "10.0.0.{}".format(i), last_login, "agent")
+
+    def run(connection, state_file: str, profile: str) -> List[str]:
+        stream = io.StringIO()
+        with contextlib.redirect_stderr(stream):
+            filtered_logger.main(connection, batch_size, True, state_file,
+                                 profile)
+        return re.findall(r'ip=([^;]*);', stream.getvalue())
+
+    for profile in filtered_logger.EXPORT_PROFILES:
+        connection = sqlite3.connect(':memory:')
+        connection.execute("CREATE TABLE users ({});".format(
+            ','.join(COLUMNS)))
+        rows = [row(i, None if i % 7 == 0 else
+                    "2023-01-{:02d} 00:00:00".format(i // 4 + 1))
+                for i in range(count)]
+        rng.shuffle(rows)
+        insert = "INSERT INTO users VALUES ({});".format(
+            ','.join('?' * len(COLUMNS)))
+        connection.executemany(insert, rows)
+        state_file = os.path.join(tempfile.mkdtemp(), "state.json")
+        first = run(connection, state_file, profile)
+        connection.executemany(insert, [
+            row(i, "2023-02-{:02d} 00:00:00".format(i // 4))
+            for i in range(count, count + batch_size * 2)])
+        second = run(connection, state_file, profile)
+        third = run(connection, state_file, profile)
+        expected = ["10.0.0.{}".format(i) for i in range(count)]
+        added = ["10.0.0.{}".format(i)
+                 for i in range(count, count + batch_size * 2)]
+        if sorted(first) != sorted(expected) or \
+                sorted(second) != sorted(added) or third:
+            raise AssertionError(
+                "{} incremental export logged {}, {} and {} rows for {} "
+                "and {}".format(profile, len(first), len(second),
+                                len(third), count, len(added)))
+    print("incremental exports log every row once for each profile")
+
+
+def bench_logging(threads: int = 4, records: int = 20000):
+    """Compares sync and async logging throughput from several threads.
+    """
+    logger = filtered_logger.get_logger()
+    for asynchronous in (False, True):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        with open(os.devnull, 'w') as stream:
+            filtered_logger.get_logger(asynchronous, stream)
+            workers = [
+                Thread(target=lambda: [
+                    logger.info(MESSAGE) for _ in range(records)
+                ])
+                for _ in range(threads)
+            ]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            emitted = time.perf_counter() - start
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+            total = time.perf_counter() - start
+        print("{:<6} {:>10.0f} records/s in callers, {:>10.0f} records/s"
+              " written".format(
+                  'async' if asynchronous else 'sync',
+                  threads * records / emitted, threads * records / total,
+              ))
+
+
+def bench_hashing(passwords: int = 16):
+    """Measures hashing throughput as the worker count grows.
+    """
+    batch = ['password{}'.format(i) for i in range(passwords)]
+    workers = 1
+    while True:
+        start = time.perf_counter()
+        hashes = list(encrypt_password.hash_many(batch, workers))
+        elapsed = time.perf_counter() - start
+        if not all(encrypt_password.verify_many(zip(hashes, batch))):
+            raise AssertionError("Hashes do not match their passwords")
+        print("{:>3} workers {:>8.2f} hashes/s".format(
+            workers, passwords / elapsed,
+        ))
+        if workers >= encrypt_password.WORKERS:
+            break
+        workers = min(workers * 2, encrypt_password.WORKERS)
+
+
+def synthetic_rows(count: int, seed: int = 0) -> List[tuple]:
+    """Generates rows shaped like the ones in user_data.csv.
+    """
+    rng = random.Random(seed)
+
+    def word(size: int) -> str:
+        return ''.join(rng.choice(string.ascii_lowercase) for _ in range(size))
+
+    rows = []
+    for _ in range(count):
+        rows.append((
+            "{} {}".format(word(6).title(), word(7).title()),
+            "{}@{}.com".format(word(8), word(5)),
+            "({}) {}-{}".format(rng.randint(100, 999),
+                                rng.randint(100, 999),
+                                rng.randint(1000, 9999)),
+            "{}-{}-{}".format(rng.randint(100, 999), rng.randint(10, 99),
+                              rng.randint(1000, 9999)),
+            ''.join(rng.choice(string.printable[:94]) for _ in range(8)),
+            ':'.join('{:x}'.format(rng.randint(0, 65535)) for _ in range(8)),
+            "2019-11-14 {:02}:{:02}:{:02}".format(
+                rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+            ),
+            rng.choice(USER_AGENTS),
+        ))
+    return rows
+
+
+def stages(rows: List[tuple]) -> dict:
+    """Builds the stages of the redaction path, each one a function
+    processing an iterable of inputs drawn from the sample rows.
+    """
+    messages = list(filtered_logger.format_rows(COLUMNS, rows))
+    records = list(filtered_logger.make_records(messages))
+    formatter = filtered_logger.RedactingFormatter(filtered_logger.PII_FIELDS)
+    fields = filtered_logger.PII_FIELDS
+
+    def drain(items: Iterable):
+        for _ in items:
+            pass
+
+    return {
+        'format_rows': (rows, lambda x: drain(
+            filtered_logger.format_rows(COLUMNS, x))),
+        'make_records': (messages, lambda x: drain(
+            filtered_logger.make_records(x))),
+        'filter_datum': (messages, lambda x: drain(
+            filtered_logger.filter_datum(fields, "***", msg, ";")
+            for msg in x)),
+        'formatter': (records, lambda x: drain(map(formatter.format, x))),
+        'pipeline': (rows, lambda x: drain(map(
+            formatter.format,
+            filtered_logger.make_records(
+                filtered_logger.format_rows(COLUMNS, x)),
+        ))),
+        'structured': (rows, lambda x: drain(map(
+            formatter.format,
+            filtered_logger.make_row_records(COLUMNS, x),
+        ))),
+    }
+
+
+def cycle(items: List, count: int) -> Iterator:
+    """Yields count items by cycling through a sample.
+    """
+    return itertools.islice(itertools.cycle(items), count)
+
+
+def run_suite(scale: int) -> dict:
+    """Measures lines/sec of each stage at a scale, and the peak
+    and retained traced memory of a fixed-size run.
+    """
+    rows = synthetic_rows(min(scale, SAMPLE_ROWS))
+    results = {}
+    for name, (sample, stage) in stages(rows).items():
+        start = time.perf_counter()
+        stage(cycle(sample, scale))
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        stage(cycle(sample, ALLOCATION_ROWS))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {
+            'lines_per_sec': scale / elapsed,
+            'peak_bytes': peak,
+            'retained_bytes': current,
+        }
+    return results
+
+
+def check_regressions(
+        results: dict, baseline: dict, threshold: float,
+        ) -> List[str]:
+    """Lists the stages slower than the baseline by more than
+    the threshold ratio.
+    """
+    failures = []
+    for scale, stats in results.items():
+        for name, result in stats.items():
+            expected = baseline.get(scale, {}).get(name)
+            if expected is None:
+                continue
+            floor = expected['lines_per_sec'] * (1 - threshold)
+            if result['lines_per_sec'] < floor:
+                failures.append("{} at {} rows: {:.0f} < {:.0f} lines/s"
+                                .format(name, scale,
+                                        result['lines_per_sec'], floor))
+    return failures
+
+
+def suite(args: argparse.Namespace) -> int:
+    """Runs the stage suite and compares it with the stored baseline.
+    """
+    results = {}
+    for scale in args.scales:
+        results[str(scale)] = run_suite(scale)
+        for name, result in results[str(scale)].items():
+            print("{:>8} {:<14} {:>12.0f} lines/s {:>9} B peak"
+                  " {:>9} B retained".format(
+                      scale, name, result['lines_per_sec'],
+                      result['peak_bytes'], result['retained_bytes'],
+                  ))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    failures = check_regressions(results, baseline, args.threshold)
+    for failure in failures:
+        print("REGRESSION {}".format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--suite', action='store_true',
+                        help="run the redaction stage suite only")
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed slowdown ratio against the baseline")
+    args = parser.parse_args()
+    if args.suite:
+        sys.exit(suite(args))
+    bench_filter_datum()
+    check_backends()
+    bench_backends()
+    bench_field_counts()
+    bench_timestamps()
+    check_incremental()
+    bench_export_profiles()
+    bench_logging()
+    bench_hashing()
@@ -1,16 +1,127 @@
 #!/usr/bin/env python3
 """A module for encrypting passwords.
 """
+import os
+import time
 import bcrypt
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple
 
 
-def hash_password(password: str) -> bytes:
+WORKERS = os.cpu_count() or 1
+DEFAULT_ROUNDS = 12
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+HASH_LATENCY = float(os.getenv("PERSONAL_DATA_HASH_LATENCY", "0.25"))
+settings = {'rounds': DEFAULT_ROUNDS}
+
+
+def hash_password(password: str, rounds: int = None) -> bytes:
     """Hashes a password using a random salt.
     """
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    salt = bcrypt.gensalt(rounds or settings['rounds'])
+    return bcrypt.hashpw(password.encode('utf-8'), salt)
 
 
 def is_valid(hashed_password: bytes, password: str) -> bool:
     """Checks is a hashed password was formed from the given password.
     """
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+
+
+def hash_rounds(hashed_password: bytes) -> int:
+    """Retrieves the work factor of a bcrypt hash.
+    """
+    return int(hashed_password.split(b'$')[2])
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """Checks if a hash was made with a lower work factor than
+    the current one.
+    """
+    return hash_rounds(hashed_password) < settings['rounds']
+
+
+def check_password(hashed_password: bytes, password: str) -> Tuple[bool, bool]:
+    """Checks a password and reports if its hash should be replaced
+    with one using the current work factor.
+    """
+    valid = is_valid(hashed_password, password)
+    return valid, valid and needs_rehash(hashed_password)
+
+
+def calibrate(target: float = HASH_LATENCY, samples: int = 3,
+              min_rounds: int = DEFAULT_ROUNDS) -> int:
+    """Picks the highest work factor whose hashing time stays within
+    a target latency (in seconds) on this machine and makes it the
+    current one. It never goes below min_rounds, so a slow host
+    does not weaken the hashes.
+    """
+    if not MIN_ROUNDS <= min_rounds <= MAX_ROUNDS:
+        raise ValueError("Invalid minimum rounds: {}".format(min_rounds))
+
+    def measure(rounds: int) -> float:
+        salt = bcrypt.gensalt(rounds)
+        times = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            bcrypt.hashpw(b'calibration', salt)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    rounds = min_rounds
+    elapsed = measure(rounds)
+    while rounds < MAX_ROUNDS and elapsed * 2 <= target:
+        elapsed = measure(rounds + 1)
+        if elapsed > target:
+            break
+        rounds += 1
+    settings['rounds'] = rounds
+    return rounds
+
+
+def _is_valid_pair(pair: Tuple[bytes, str]) -> bool:
+    """Checks a (hashed password, password) pair.
+    """
+    return is_valid(*pair)
+
+
+def _map_ordered(
+        func: Callable, items: Iterable, workers: int, processes: bool,
+        ) -> Iterator:
+    """Applies a function to items in a pool of workers and yields
+    the results in input order, keeping a bounded number of tasks
+    in flight.
+    """
+    workers = workers or WORKERS
+    pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool_class(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def hash_many(
+        passwords: Iterable[str], workers: int = None,
+        processes: bool = False,
+        ) -> Iterator[bytes]:
+    """Hashes passwords in parallel, yielding hashes in input order.
+    bcrypt releases the GIL, so threads are used unless processes
+    is set.
+    """
+    return _map_ordered(hash_password, passwords, workers, processes)
+
+
+def verify_many(
+        pairs: Iterable[Tuple[bytes, str]], workers: int = None,
+        processes: bool = False,
+        ) -> Iterator[bool]:
+    """Checks (hashed password, password) pairs in parallel, yielding
+    the results in input order.
+    """
+    return _map_ordered(_is_valid_pair, pairs, workers, processes)
@@ -3,9 +3,20 @@
 """
 import os
 import re
+import sys
+import json
+import time
 import logging
+import logging.handlers
 import mysql.connector
-from typing import List
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from operator import attrgetter
+from queue import Empty, Full, LifoQueue, Queue
+from threading import Lock, Thread
+from typing import (
+    Callable, Iterable, Iterator, List, TextIO, Tuple,
+)
 
 
 patterns = {
@@ -13,6 +24,200 @@ patterns = {
     'replace': lambda x: r'\g<field>={}'.format(x),
 }
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
+REDACTOR_CACHE_SIZE = 32
+SCAN_MEMO_SIZE = 4096
+FETCH_BATCH_SIZE = 1000
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 256
+OVERFLOW_POLICIES = ('block', 'drop', 'count')
+DB_POOL_SIZE = 5
+STATE_FILE = ".filtered_logger_state.json"
+USER_COLUMNS = (
+    "name", "email", "phone", "ssn", "password", "ip", "last_login",
+    "user_agent",
+)
+WATERMARK_COLUMNS = ("last_login", "email")
+WATERMARK_ALIAS = "_wm_{}"
+EXPORT_PROFILES = {
+    'full': (USER_COLUMNS, ()),
+    'redacted': (USER_COLUMNS, PII_FIELDS),
+    'compact': (USER_COLUMNS[:-1], PII_FIELDS),
+    'activity': (("ip", "last_login"), ()),
+}
+
+
+class Redactor:
+    """Redacts the values of a set of fields in log lines.
+    The pattern is compiled once and the replacement is a plain
+    callable, which avoids expanding a template on every match.
+    """
+
+    def __init__(self, fields: List[str], redaction: str, separator: str):
+        """Initializes a redactor for the given fields.
+        """
+        self.fields = tuple(fields)
+        self.redaction = redaction
+        self.separator = separator
+        extract = patterns["extract"]
+        self.pattern = re.compile(extract(self.fields, separator))
+        self.key_pattern = re.compile(r'(?:{})\Z'.format('|'.join(fields)))
+        suffix = '={}'.format(redaction)
+        self.replacement = lambda x: x.group('field') + suffix
+
+    def match(self, key: str) -> bool:
+        """Checks if the value following a key would be redacted,
+        that is if the key ends with one of the fields.
+        """
+        return self.key_pattern.search(key) is not None
+
+    def filter(self, message: str) -> str:
+        """Filters a log line.
+        """
+        return self.pattern.sub(self.replacement, message)
+
+    def filter_many(self, messages: Iterable[str]) -> List[str]:
+        """Filters a batch of log lines.
+        """
+        sub, replacement = (self.pattern.sub, self.replacement)
+        return [sub(replacement, message) for message in messages]
+
+
+class ScanRedactor:
+    """Redacts the values of a set of fields in log lines by
+    scanning each separated segment once instead of running the
+    field alternation at every position.
+    Produces the same output as Redactor.
+    """
+
+    def __init__(self, fields: List[str], redaction: str, separator: str):
+        """Initializes a redactor for the given fields.
+        """
+        self.fields = tuple(fields)
+        self.redaction = redaction
+        self.separator = separator
+        self.keys = frozenset(self.fields)
+        self.sizes = sorted(set(map(len, self.keys)), reverse=True)
+        self.suffix = '={}'.format(redaction)
+        self.matches = {}
+
+    def _match(self, key: str) -> bool:
+        """Checks if a key ends with one of the fields.
+        Results are memoized since keys repeat across log lines.
+        """
+        found = key in self.keys or any(
+            size < len(key) and key[len(key) - size:] in self.keys
+            for size in self.sizes
+        )
+        if len(self.matches) >= SCAN_MEMO_SIZE:
+            self.matches.clear()
+        self.matches[key] = found
+        return found
+
+    def match(self, key: str) -> bool:
+        """Checks if the value following a key would be redacted.
+        """
+        found = self.matches.get(key)
+        return self._match(key) if found is None else found
+
+    def filter(self, message: str) -> str:
+        """Filters a log line.
+        """
+        if '=' not in message:
+            return message
+        matches, match = (self.matches, self._match)
+        segments = message.split(self.separator)
+        for i, segment in enumerate(segments):
+            key, eq, value = segment.partition('=')
+            if not eq:
+                continue
+            found = matches.get(key)
+            if found is None:
+                found = match(key)
+            if found:
+                segments[i] = key + self.suffix
+            elif '=' in value:
+                segments[i] = self._filter_value(segment, len(key))
+        return self.separator.join(segments)
+
+    def _filter_value(self, segment: str, end: int) -> str:
+        """Redacts a segment whose first key did not match by
+        trying the keys that follow the next equal signs.
+        """
+        start, end = (end + 1, segment.find('=', end + 1))
+        while end >= 0:
+            if self._match(segment[start:end]):
+                return segment[:end] + self.suffix
+            start, end = (end + 1, segment.find('=', end + 1))
+        return segment
+
+    def filter_many(self, messages: Iterable[str]) -> List[str]:
+        """Filters a batch of log lines.
+        """
+        return list(map(self.filter, messages))
+
+
+class TrieRedactor(ScanRedactor):
+    """Redacts the values of a set of fields in log lines, matching
+    keys against a trie of the reversed field names.
+    The cost of a lookup depends on the length of the key, not on
+    the number of fields.
+    """
+
+    def __init__(self, fields: List[str], redaction: str, separator: str):
+        """Initializes a redactor for the given fields.
+        """
+        super(TrieRedactor, self).__init__(fields, redaction, separator)
+        self.trie = {}
+        for field in self.keys:
+            node = self.trie
+            for char in reversed(field):
+                node = node.setdefault(char, {})
+            node[''] = True
+
+    def _match(self, key: str) -> bool:
+        """Checks if a key ends with one of the fields by walking
+        the trie from the last character of the key.
+        """
+        node = self.trie
+        found = '' in node
+        for char in reversed(key):
+            if found:
+                break
+            node = node.get(char)
+            if node is None:
+                break
+            found = '' in node
+        if len(self.matches) >= SCAN_MEMO_SIZE:
+            self.matches.clear()
+        self.matches[key] = found
+        return found
+
+
+REDACTORS = {
+    'regex': Redactor,
+    'scan': ScanRedactor,
+    'trie': TrieRedactor,
+}
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _cached_redactor(
+        fields: tuple, redaction: str, separator: str, backend: str,
+        ) -> Redactor:
+    """Creates a redactor for a hashable set of options.
+    """
+    return REDACTORS[backend](fields, redaction, separator)
+
+
+def get_redactor(
+        fields: List[str], redaction: str, separator: str,
+        backend: str = 'regex',
+        ) -> Redactor:
+    """Retrieves a shared redactor from a bounded LRU cache.
+    """
+    if backend not in REDACTORS:
+        raise ValueError("Unknown redaction backend: {}".format(backend))
+    return _cached_redactor(tuple(fields), redaction, separator, backend)
 
 
 def filter_datum(
@@ -20,8 +225,7 @@ def filter_datum(
         ) -> str:
     """Filters a log line.
     """
-    extract, replace = (patterns["extract"], patterns["replace"])
-    return re.sub(extract(fields, separator), replace(redaction), message)
+    return get_redactor(fields, redaction, separator).filter(message)
 
 
 class RedactingFormatter(logging.Formatter):
@@ -33,27 +237,246 @@ class RedactingFormatter(logging.Formatter):
     FORMAT_FIELDS = ('name', 'levelname', 'asctime', 'message')
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], backend: str = 'regex',
+                 compiled: bool = False):
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.redactor = get_redactor(
+            fields, self.REDACTION, self.SEPARATOR, backend,
+        )
+        self.compiled = compiled
+        self.template = re.sub(r'%\(\w+\)', '%', self.FORMAT)
+        self.values = attrgetter(*self.FORMAT_FIELDS)
+        self._second = (None, None)
+
+    def formatTime(self, record: logging.LogRecord,
+                   datefmt: str = None) -> str:
+        """Formats the creation time of a LogRecord, rendering the
+        part without milliseconds once per second.
+        """
+        if datefmt is not None:
+            return super(RedactingFormatter, self).formatTime(record, datefmt)
+        second, prefix = self._second
+        if second != int(record.created):
+            second = int(record.created)
+            prefix = time.strftime(self.default_time_format,
+                                   self.converter(record.created))
+            self._second = (second, prefix)
+        return self.default_msec_format % (prefix, record.msecs)
 
     def format(self, record: logging.LogRecord) -> str:
         """formats a LogRecord.
+        Rows carried by a RowMessage are redacted field by field
+        before the line is rendered, so no regex pass is needed.
         """
+        if type(record.msg) is RowMessage:
+            record.message = record.msg.render(self.redactor)
+            record.asctime = self.formatTime(record, self.datefmt)
+            return self.render(record)
+        if self.compiled and not (record.exc_info or record.stack_info):
+            record.message = record.getMessage()
+            record.asctime = self.formatTime(record, self.datefmt)
+            return self.redactor.filter(self.render(record))
         msg = super(RedactingFormatter, self).format(record)
-        txt = filter_datum(self.fields, self.REDACTION, msg, self.SEPARATOR)
-        return txt
+        return self.redactor.filter(msg)
+
+    def render(self, record: logging.LogRecord) -> str:
+        """Renders the format of a LogRecord whose message and time
+        are already set.
+        When compiled, the format is filled positionally from
+        FORMAT_FIELDS instead of through the record's attributes.
+        """
+        if self.compiled:
+            return self.template % self.values(record)
+        return self.formatMessage(record)
+
+
+class RowMessage:
+    """A log message holding a table row as a mapping of columns
+    to values.
+    """
+
+    def __init__(self, row: dict):
+        """Initializes a message for a row.
+        """
+        self.row = row
+
+    def render(self, redactor: Redactor) -> str:
+        """Renders the row as key=value pairs redacted the way the
+        redactor would redact the whole line. Values are replaced
+        when their key matches, and pairs are only filtered when they
+        could contain an embedded key=value pair or a separator.
+        """
+        match, filter = (redactor.match, redactor.filter)
+        separator, suffix = (redactor.separator, '=' + redactor.redaction)
+        pairs = []
+        for key, value in self.row.items():
+            pair = '{}={}'.format(key, value)
+            if pair.count('=') > 1 or separator in pair:
+                pairs.append(filter(pair))
+            elif match(key):
+                pairs.append(key + suffix)
+            else:
+                pairs.append(pair)
+        return '{};'.format('; '.join(pairs))
+
+    def __str__(self) -> str:
+        """Renders the row with the personal data fields redacted.
+        """
+        return self.render(get_redactor(
+            PII_FIELDS, RedactingFormatter.REDACTION,
+            RedactingFormatter.SEPARATOR,
+        ))
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """Hands records over to a bounded queue without formatting them
+    in the calling thread.
+    """
+
+    def __init__(self, queue: Queue, policy: str = 'block'):
+        """Initializes a handler with an overflow policy.
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(policy))
+        super(AsyncLogHandler, self).__init__(queue)
+        self.policy = policy
+        self.dropped = 0
+        self.listener = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Leaves formatting and redaction to the listener.
+        """
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        """Adds a record to the queue according to the overflow policy.
+        """
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Waits until every queued record has been written.
+        """
+        if self.listener is not None:
+            self.queue.join()
+
+    def close(self):
+        """Stops the listener after writing the pending records.
+        """
+        listener, self.listener = (self.listener, None)
+        if listener is not None:
+            listener.stop()
+            if self.policy == 'count' and self.dropped > 0:
+                msg = "{} records dropped".format(self.dropped)
+                args = ("user_data", logging.WARNING, None, None, msg,
+                        None, None)
+                listener.handler.handle(logging.LogRecord(*args))
+        super(AsyncLogHandler, self).close()
 
 
-def get_logger() -> logging.Logger:
+class BatchLogListener:
+    """Formats and writes queued records in batches from a
+    background thread.
+    """
+
+    def __init__(self, queue: Queue, handler: logging.StreamHandler,
+                 batch_size: int = LOG_BATCH_SIZE):
+        """Initializes a listener writing to a stream handler.
+        """
+        self.queue = queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self._thread = None
+
+    def start(self):
+        """Starts the background writer thread.
+        """
+        self._thread = Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Writes the remaining records and stops the writer thread.
+        """
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _monitor(self):
+        """Drains the queue until the stop sentinel is received.
+        """
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            running = len(records) == len(batch)
+            try:
+                self._write(records)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, records: List[logging.LogRecord]):
+        """Writes a batch of records with a single stream write.
+        Records that fail to format or write are reported through
+        the handler's handleError, as StreamHandler.emit does.
+        """
+        handler = self.handler
+        lines = []
+        for record in records:
+            if record.levelno < handler.level:
+                continue
+            try:
+                lines.append(handler.format(record) + handler.terminator)
+            except Exception:
+                handler.handleError(record)
+        if not lines:
+            return
+        try:
+            with handler.lock:
+                handler.stream.write(''.join(lines))
+                handler.flush()
+        except Exception:
+            handler.handleError(records[-1])
+
+
+def get_logger(
+        asynchronous: bool = False, stream: TextIO = None,
+        queue_size: int = LOG_QUEUE_SIZE, policy: str = 'block',
+        ) -> logging.Logger:
     """Creates a new logger for user data.
+    In asynchronous mode, records are queued in the calling thread
+    and formatted, redacted and written by a background listener.
+    Handlers added by a previous call are closed and replaced, so
+    records are not written twice.
     """
     logger = logging.getLogger("user_data")
-    stream_handler = logging.StreamHandler()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    stream_handler = logging.StreamHandler(stream)
     stream_handler.setFormatter(RedactingFormatter(PII_FIELDS))
     logger.setLevel(logging.INFO)
     logger.propagate = False
-    logger.addHandler(stream_handler)
+    if asynchronous:
+        log_queue = Queue(queue_size)
+        queue_handler = AsyncLogHandler(log_queue, policy)
+        queue_handler.listener = BatchLogListener(log_queue, stream_handler)
+        queue_handler.listener.start()
+        logger.addHandler(queue_handler)
+    else:
+        logger.addHandler(stream_handler)
     return logger
 
 
@@ -74,26 +497,307 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
     return connection
 
 
-def main():
+def ping(connection) -> bool:
+    """Checks that a DB-API connection can still run a query.
+    """
+    try:
+        with closing(connection.cursor()) as cursor:
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+        return True
+    except Exception:
+        return False
+
+
+class ConnectionPool:
+    """A bounded pool of reusable database connections.
+    """
+
+    def __init__(self, factory: Callable, size: int = DB_POOL_SIZE,
+                 check: Callable = ping):
+        """Initializes a pool creating connections with a factory.
+        """
+        if size < 1:
+            raise ValueError("Pool size must be positive")
+        self.factory = factory
+        self.size = size
+        self.check = check
+        self._idle = LifoQueue(size)
+        self._lock = Lock()
+        self._created = 0
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def acquire(self, timeout: float = None):
+        """Checks out a healthy connection, waiting for one to be
+        released when the pool is exhausted.
+        Raises TimeoutError if none is released within the timeout.
+        """
+        try:
+            connection = self._idle.get_nowait()
+        except Empty:
+            connection = self._create()
+        if connection is None:
+            start = time.perf_counter()
+            try:
+                connection = self._idle.get(timeout=timeout)
+            except Empty:
+                raise TimeoutError("Connection pool exhausted: no "
+                                   "connection released within "
+                                   "{}s".format(timeout)) from None
+            finally:
+                with self._lock:
+                    self._waits += 1
+                    self._wait_time += time.perf_counter() - start
+        if self.check is not None and not self.check(connection):
+            self._discard(connection)
+            try:
+                connection = self.factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        with self._lock:
+            self._in_use += 1
+        return connection
+
+    def _create(self):
+        """Opens a new connection if the pool has room for one.
+        """
+        with self._lock:
+            if self._created >= self.size:
+                return None
+            self._created += 1
+        try:
+            return self.factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def release(self, connection):
+        """Returns a connection to the pool.
+        """
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(connection)
+
+    def _discard(self, connection):
+        """Closes a broken connection that was checked out.
+        """
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """Checks out a connection for the duration of a block.
+        """
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def stats(self) -> dict:
+        """Retrieves the usage statistics of the pool.
+        """
+        with self._lock:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+            }
+
+    def close(self):
+        """Closes the idle connections of the pool.
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            self._discard(connection)
+
+
+@lru_cache(maxsize=1)
+def get_db_pool() -> ConnectionPool:
+    """Retrieves the shared pool of database connections.
+    """
+    size = int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE", DB_POOL_SIZE))
+    return ConnectionPool(get_db, size)
+
+
+def fetch_batches(
+        cursor, batch_size: int = FETCH_BATCH_SIZE,
+        ) -> Iterator[List]:
+    """Streams the rows of an executed query as fixed-size batches.
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+
+def load_watermark(state_file: str) -> dict:
+    """Loads the last exported (last_login, email) position.
+    """
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def save_watermark(state_file: str, watermark: dict):
+    """Atomically replaces the stored export position.
+    """
+    tmp_file = '{}.tmp'.format(state_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(watermark, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, state_file)
+
+
+def placeholder(connection) -> str:
+    """Retrieves the query parameter marker of a DB-API connection.
+    """
+    module = type(connection).__module__
+    while module:
+        paramstyle = getattr(sys.modules.get(module), 'paramstyle', None)
+        if paramstyle is not None:
+            return '?' if paramstyle == 'qmark' else '%s'
+        module = module.rpartition('.')[0]
+    return '%s'
+
+
+def format_rows(columns: List[str], rows: Iterable) -> Iterator[str]:
+    """Formats table rows into key=value log messages.
+    """
+    for row in rows:
+        record = map(
+            lambda x: '{}={}'.format(x[0], x[1]),
+            zip(columns, row),
+        )
+        yield '{};'.format('; '.join(list(record)))
+
+
+def make_records(messages: Iterable[str]) -> Iterator[logging.LogRecord]:
+    """Wraps log messages into user data log records.
+    """
+    for msg in messages:
+        args = ("user_data", logging.INFO, None, None, msg, None, None)
+        yield logging.LogRecord(*args)
+
+
+def make_row_records(
+        columns: List[str], rows: Iterable,
+        ) -> Iterator[logging.LogRecord]:
+    """Wraps table rows into user data log records carrying
+    the row itself rather than a preformatted message.
+    """
+    for row in rows:
+        msg = RowMessage(dict(zip(columns, row)))
+        args = ("user_data", logging.INFO, None, None, msg, None, None)
+        yield logging.LogRecord(*args)
+
+
+def export_query(profile: str = 'full', incremental: bool = False,
+                 resume: bool = False, mark: str = '%s',
+                 resume_null: bool = False) -> Tuple[List[str], str]:
+    """Builds the users query of an export profile.
+    Redacted columns are replaced by the redaction in SQL so their
+    values never leave the database. In incremental mode, the
+    watermark columns are appended after the profile's columns under
+    their own aliases, since a profile may redact them, and rows are
+    ordered by the table's columns, rows without a last login first,
+    starting after the watermark when resuming. resume_null tells
+    that the watermark is on a row without a last login.
+    """
+    if profile not in EXPORT_PROFILES:
+        raise ValueError("Unknown export profile: {}".format(profile))
+    columns, redacted = EXPORT_PROFILES[profile]
+    select = [
+        "'{}' AS {}".format(RedactingFormatter.REDACTION, column)
+        if column in redacted else column
+        for column in columns
+    ]
+    if not incremental:
+        return list(columns), "SELECT {} FROM users;".format(','.join(select))
+    select.extend(
+        "users.{} AS {}".format(column, WATERMARK_ALIAS.format(column))
+        for column in WATERMARK_COLUMNS
+    )
+    clauses = ["SELECT {} FROM users".format(','.join(select))]
+    if resume and resume_null:
+        clauses.append("WHERE users.last_login IS NOT NULL")
+        clauses.append("OR (users.last_login IS NULL AND users.email > {})"
+                       .format(mark))
+    elif resume:
+        clauses.append("WHERE users.last_login > {0}".format(mark))
+        clauses.append("OR (users.last_login = {0} AND users.email > {0})"
+                       .format(mark))
+    clauses.append("ORDER BY users.last_login IS NOT NULL, users.last_login,"
+                   " users.email;")
+    return list(columns), ' '.join(clauses)
+
+
+def main(connection=None, batch_size: int = None,
+         incremental: bool = False, state_file: str = None,
+         profile: str = None):
     """Logs the information about user records in a table.
+    Rows are streamed in batches so memory use does not depend
+    on the size of the table.
+    In incremental mode, only the rows past the stored watermark
+    are logged and the watermark moves after every batch.
     """
-    fields = "name,email,phone,ssn,password,ip,last_login,user_agent"
-    columns = fields.split(',')
-    query = "SELECT {} FROM users;".format(fields)
+    if batch_size is None:
+        batch_size = int(os.getenv(
+            "PERSONAL_DATA_BATCH_SIZE", FETCH_BATCH_SIZE,
+        ))
+    if state_file is None:
+        state_file = os.getenv("PERSONAL_DATA_STATE_FILE", STATE_FILE)
+    if profile is None:
+        profile = os.getenv("PERSONAL_DATA_EXPORT_PROFILE", 'full')
     info_logger = get_logger()
-    connection = get_db()
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        for row in rows:
-            record = map(
-                lambda x: '{}={}'.format(x[0], x[1]),
-                zip(columns, row),
-            )
-            msg = '{};'.format('; '.join(list(record)))
-            args = ("user_data", logging.INFO, None, None, msg, None, None)
-            log_record = logging.LogRecord(*args)
-            info_logger.handle(log_record)
+    owned = connection is None
+    if owned:
+        connection = get_db()
+    watermark = load_watermark(state_file) if incremental else None
+    resume_null = watermark is not None and watermark['last_login'] is None
+    columns, query = export_query(profile, incremental,
+                                  watermark is not None,
+                                  placeholder(connection), resume_null)
+    params = ()
+    if resume_null:
+        params = (watermark['email'], )
+    elif watermark is not None:
+        params = (
+            watermark['last_login'], watermark['last_login'],
+            watermark['email'],
+        )
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(query, params)
+        for rows in fetch_batches(cursor, batch_size):
+            for log_record in make_row_records(columns, rows):
+                info_logger.handle(log_record)
+            if incremental:
+                last_login, email = rows[-1][len(columns):]
+                save_watermark(state_file, {
+                    'last_login': None if last_login is None
+                    else str(last_login),
+                    'email': email,
+                })
+    if owned:
+        connection.close()
 
 
 if __name__ == "__main__":
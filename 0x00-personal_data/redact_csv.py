@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""A module for turning user data CSV dumps into redacted logs.
+"""
+import argparse
+import csv
+import itertools
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, TextIO, Tuple
+
+filtered_logger = __import__('filtered_logger')
+
+
+CHUNK_SIZE = 5000
+WORKERS = os.cpu_count() or 1
+formatters = {}
+
+
+def read_chunks(
+        stream: TextIO, chunk_size: int = CHUNK_SIZE,
+        ) -> Tuple[List[str], Iterator[List[List[str]]]]:
+    """Reads the header of a CSV dump and the remaining rows
+    in chunks.
+    """
+    reader = csv.reader(stream)
+    columns = next(reader)
+
+    def chunks():
+        while True:
+            chunk = list(itertools.islice(reader, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+
+    return columns, chunks()
+
+
+def redact_chunk(columns: List[str], rows: List[List[str]]) -> str:
+    """Formats and redacts a chunk of rows the way the user_data
+    logger would.
+    """
+    formatter = formatters.get('user_data')
+    if formatter is None:
+        formatter = filtered_logger.RedactingFormatter(
+            filtered_logger.PII_FIELDS,
+        )
+        formatters['user_data'] = formatter
+    records = filtered_logger.make_row_records(columns, rows)
+    return ''.join(formatter.format(x) + '\n' for x in records)
+
+
+def redact_csv(
+        source: TextIO, target: TextIO, chunk_size: int = CHUNK_SIZE,
+        workers: int = WORKERS,
+        ) -> int:
+    """Redacts a CSV dump into a log stream using a process pool,
+    keeping the original row order. Returns the number of rows.
+    """
+    columns, chunks = read_chunks(source, chunk_size)
+    count = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            count += len(chunk)
+            pending.append(pool.submit(redact_chunk, columns, chunk))
+            if len(pending) >= workers * 2:
+                target.write(pending.popleft().result())
+        while pending:
+            target.write(pending.popleft().result())
+    return count
+
+
+def main():
+    """Redacts a user data CSV dump from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('source', help="CSV file with a header row")
+    parser.add_argument('-o', '--output', help="log file (default: stdout)")
+    parser.add_argument('-c', '--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    with open(args.source, 'r', newline='') as source:
+        if args.output is None:
+            count = redact_csv(source, sys.stdout, args.chunk_size,
+                               args.workers)
+        else:
+            with open(args.output, 'w') as target:
+                count = redact_csv(source, target, args.chunk_size,
+                                   args.workers)
+    elapsed = time.perf_counter() - start
+    print("{} rows in {:.2f}s ({:.0f} rows/s)".format(
+        count, elapsed, count / elapsed if elapsed else 0,
+    ), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""A module for redacting personal data in existing log files.
+"""
+import argparse
+import mmap
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+
+filtered_logger = __import__('filtered_logger')
+
+
+CHUNK_SIZE = 16 * 1024 * 1024
+WORKERS = os.cpu_count() or 1
+REDACTION = filtered_logger.RedactingFormatter.REDACTION
+SEPARATOR = filtered_logger.RedactingFormatter.SEPARATOR
+
+
+@lru_cache(maxsize=8)
+def compile_pattern(fields: List[str], separator: str) -> re.Pattern:
+    """Compiles the filter_datum pattern for raw bytes.
+    Values also stop at line ends, so a whole chunk of lines is
+    redacted the same way as each line on its own.
+    """
+    extract = filtered_logger.patterns["extract"]
+    return re.compile(extract(fields, separator + '\n').encode('utf-8'))
+
+
+def split_lines(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple]:
+    """Splits a file into (start, end) ranges ending at line boundaries.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                end = mm.find(b'\n', min(start + chunk_size, size) - 1)
+                end = size if end < 0 else end + 1
+                yield start, end
+                start = end
+
+
+def redact_range(
+        path: str, start: int, end: int, fields: List[str],
+        redaction: str = REDACTION, separator: str = SEPARATOR,
+        ) -> bytes:
+    """Redacts a range of a memory-mapped log file.
+    """
+    pattern = compile_pattern(tuple(fields), separator)
+    suffix = '={}'.format(redaction).encode('utf-8')
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return pattern.sub(lambda x: x.group('field') + suffix,
+                               mm[start:end])
+
+
+def redact_file(
+        source: str, target: str, fields: List[str] = None,
+        chunk_size: int = CHUNK_SIZE, workers: int = WORKERS,
+        ) -> int:
+    """Redacts a log file into another one using a process pool.
+    Returns the number of bytes read.
+    """
+    fields = tuple(fields or filtered_logger.PII_FIELDS)
+    total = 0
+    with open(target, 'wb') as out, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for start, end in split_lines(source, chunk_size):
+            total += end - start
+            pending.append(pool.submit(
+                redact_range, source, start, end, fields,
+            ))
+            if len(pending) >= workers * 2:
+                out.write(pending.popleft().result())
+        while pending:
+            out.write(pending.popleft().result())
+    return total
+
+
+def main():
+    """Redacts a log file from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('source', help="log file to redact")
+    parser.add_argument('target', nargs='?',
+                        help="redacted log file (default: SOURCE.redacted)")
+    parser.add_argument('-i', '--in-place', action='store_true',
+                        help="replace the source once it is redacted")
+    parser.add_argument('-f', '--fields', nargs='+',
+                        default=filtered_logger.PII_FIELDS)
+    parser.add_argument('-c', '--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS)
+    args = parser.parse_args()
+    target = args.target or '{}.redacted'.format(args.source)
+    start = time.perf_counter()
+    total = redact_file(args.source, target, args.fields,
+                        args.chunk_size, args.workers)
+    if args.in_place:
+        os.replace(target, args.source)
+    elapsed = time.perf_counter() - start
+    print("{:.1f} MB in {:.2f}s ({:.1f} MB/s)".format(
+        total / 1e6, elapsed, total / 1e6 / elapsed if elapsed else 0,
+    ), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
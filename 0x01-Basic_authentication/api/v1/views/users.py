@@ -2,18 +2,108 @@
 """ Module of Users views
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import Response, abort, jsonify, request
+from heapq import nsmallest
+from models.base import format_timestamp, json_dumps, parse_timestamp
 from models.user import User
 
 
+# created_at is compared at the resolution of the files, so cursors
+# stay valid in workers that loaded the users from them
+USERS_ORDERS = {
+    'id': lambda user: (user.id, ),
+    'created_at': lambda user: (user.created_at.replace(microsecond=0),
+                                user.id),
+}
+
+
+def users_page(order: str, cursor: str, limit: int) -> list:
+    """ Return the users following a cursor in a stable order,
+    without sorting the whole collection
+    Without an order, cursor or limit, all users are returned
+    in storage order
+    """
+    users = User.all()
+    if order is None and cursor is None and limit is None:
+        return users
+    order = order or 'id'
+    key = USERS_ORDERS[order]
+    if cursor is not None:
+        if order == 'id':
+            after = (cursor, )
+        else:
+            created_at, _, user_id = cursor.partition(',')
+            after = (parse_timestamp(created_at), user_id)
+        users = (user for user in users if key(user) > after)
+    if limit is None:
+        return sorted(users, key=key)
+    return nsmallest(limit, users, key=key)
+
+
+def users_cursor(order: str, user: User) -> str:
+    """ Return the cursor pointing after a user
+    """
+    if order == 'id':
+        return user.id
+    return "{},{}".format(format_timestamp(user.created_at), user.id)
+
+
+def users_response(users: list, headers: dict = None) -> Response:
+    """ Return a JSON array of users, encoded like jsonify
+    but with JSON_ENCODER
+    """
+    serializer = User.serializer()
+    body = json_dumps([serializer(user) for user in users],
+                      sort_keys=True, separators=(',', ':'))
+    return Response(body + '\n', headers=headers,
+                    mimetype='application/json')
+
+
+def stream_users(users: list):
+    """ Yield a JSON array of users one object at a time
+    """
+    serializer = User.serializer()
+    yield '['
+    for i, user in enumerate(users):
+        yield (',' if i > 0 else '') + json_dumps(serializer(user))
+    yield ']\n'
+
+
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters (optional):
+      - limit: maximum number of users to return
+      - cursor: X-Next-Cursor header of the previous page
+      - order: id (default) or created_at
+      - stream: if set, the JSON array is streamed
     Return:
       - list of all User objects JSON represented
+      - the page of User objects following the cursor, and the
+        cursor of the next page in the X-Next-Cursor header
+      - 400 if a parameter is invalid
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    args = request.args
+    if not any(k in args for k in ('limit', 'cursor', 'order', 'stream')):
+        return users_response(User.all())
+    order = args.get('order')
+    limit = args.get('limit')
+    try:
+        if order is not None and order not in USERS_ORDERS:
+            raise ValueError(order)
+        limit = int(limit) if limit is not None else None
+        if limit is not None and limit <= 0:
+            raise ValueError(limit)
+        users = users_page(order, args.get('cursor'), limit)
+    except ValueError:
+        return jsonify({'error': "Invalid pagination"}), 400
+    headers = {}
+    if limit is not None and len(users) == limit:
+        headers['X-Next-Cursor'] = users_cursor(order or 'id', users[-1])
+    if 'stream' in args:
+        return Response(stream_users(users), headers=headers,
+                        mimetype='application/json')
+    return users_response(users, headers)
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
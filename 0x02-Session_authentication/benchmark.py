@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+""" Benchmarks of the models storage
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import models.base as base
+from models.user import User
+from models.user_session import UserSession
+
+
+class DictUser():
+    """ User stored in a per-instance __dict__, as before __slots__
+    """
+
+    def __init__(self, **kwargs: dict):
+        """ Initialize with the attributes of a User
+        """
+        self.id = kwargs.get('id')
+        self.created_at = datetime.utcnow()
+        self.updated_at = datetime.utcnow()
+        self.email = kwargs.get('email')
+        self._password = kwargs.get('_password')
+        self.first_name = kwargs.get('first_name')
+        self.last_name = kwargs.get('last_name')
+
+
+def populate(count: int):
+    """ Fill DATA with users without writing them to a file
+    """
+    base.DATA['User'] = {}
+    base.INDEXES['User'] = base.Index(User.indexes)
+    base.SEEN.pop('User', None)
+    for i in range(count):
+        user = User(email="user{}@hbtn.io".format(i), first_name="Bob")
+        base.DATA['User'][user.id] = user
+        base.INDEXES['User'].add(user)
+
+
+def bench_search(count: int, lookups: int = 100):
+    """ Compare indexed and linear email lookups
+    """
+    populate(count)
+    emails = ["user{}@hbtn.io".format(i * count // lookups)
+              for i in range(lookups)]
+
+    def linear(email):
+        return [u for u in base.DATA['User'].values() if u.email == email]
+
+    for name, func in (('indexed', lambda e: User.search({'email': e})),
+                       ('linear', linear)):
+        number = lookups if name == 'indexed' else min(lookups, 10)
+        elapsed = timeit.timeit(
+            lambda: [func(e) for e in emails[:number]], number=1)
+        print("{:<8} {:>12.2f} us/lookup".format(
+            name, elapsed / number * 1e6))
+
+
+def bench_writes(count: int, writes: int = 200):
+    """ Compare save() throughput of the storage modes
+    with count users already stored
+    """
+    for mode in ('file', 'journal', 'write_behind'):
+        os.chdir(tempfile.mkdtemp())
+        base.STORAGE_MODE = mode
+        populate(count)
+        User.save_to_file()
+        start = time.perf_counter()
+        for i in range(writes):
+            User(email="new{}@hbtn.io".format(i)).save()
+        base.flush()
+        elapsed = time.perf_counter() - start
+        print("{:<12} {:>10.0f} saves/s".format(mode, writes / elapsed))
+    print("write-behind stats: {}".format(base.write_stats()))
+
+
+def bench_memory(count: int):
+    """ Compare the memory held by dict-backed and slotted users
+    """
+    for name, cls in (('dict', DictUser), ('slots', User)):
+        tracemalloc.start()
+        users = [cls(id=str(i), email="user{}@hbtn.io".format(i),
+                     _password="0" * 64, first_name="Bob")
+                 for i in range(count)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del users
+        print("{:<6} {:>10.1f} MB {:>8.0f} B/user".format(
+            name, size / 1e6, size / count))
+    tracemalloc.start()
+    sessions = [UserSession(user_id=str(i), session_id=str(i))
+                for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sessions
+    print("{:<6} {:>10.1f} MB {:>8.0f} B/session".format(
+        'slots', size / 1e6, size / count))
+
+
+def strptime_timestamp(value: str) -> datetime:
+    """ Parse a timestamp the way Base did before the fast path
+    """
+    return datetime.strptime(value, base.TIMESTAMP_FORMAT)
+
+
+def bench_load(count: int):
+    """ Compare load_from_file with and without the timestamp
+    fast path on a file of count users
+    """
+    os.chdir(tempfile.mkdtemp())
+    created_at = "2023-06-01T15:22:46"
+    with open(".db_User.json", 'w') as f:
+        json.dump({str(i): {
+            'id': str(i), 'created_at': created_at,
+            'updated_at': created_at, 'email': "user{}@hbtn.io".format(i),
+            '_password': "0" * 64, 'first_name': None, 'last_name': None,
+        } for i in range(count)}, f)
+    fast = base.parse_timestamp
+    for name, parse in (('strptime', strptime_timestamp), ('fast', fast)):
+        base.parse_timestamp = parse
+        start = time.perf_counter()
+        User.load_from_file()
+        elapsed = time.perf_counter() - start
+        print("{:<9} {:>8.2f} s {:>10.0f} users/s".format(
+            name, elapsed, count / elapsed))
+    base.parse_timestamp = fast
+
+
+def bench_users_endpoint(count: int):
+    """ Measure time to first byte, total time and peak traced
+    memory of GET /api/v1/users variants
+    """
+    os.environ['AUTH_TYPE'] = ''
+    from api.v1.app import app
+    client = app.test_client()
+    populate(count)
+    for query in ('', '?limit=100', '?stream=1'):
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = client.get('/api/v1/users' + query, buffered=False)
+        chunks = iter(response.response)
+        size = len(next(chunks))
+        first = time.perf_counter() - start
+        size += sum(len(chunk) for chunk in chunks)
+        total = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        response.close()
+        print("{:<12} ttfb {:>8.3f} s total {:>8.3f} s peak {:>8.1f} MB"
+              " body {:>8.1f} MB".format(query or '(all)', first, total,
+                                         peak / 1e6, size / 1e6))
+
+
+def bench_serialize(count: int):
+    """ Compare to_json throughput of the attribute walk and the
+    compiled serializer, and save_to_file with each JSON encoder
+    """
+    populate(count)
+    users = list(base.DATA['User'].values())
+    serializer = User.serializer()
+    for name, func in (('walk', lambda u: u.to_json_slow()),
+                       ('compiled', serializer)):
+        start = time.perf_counter()
+        for user in users:
+            func(user)
+        elapsed = time.perf_counter() - start
+        print("{:<9} {:>10.0f} users/s".format(name, count / elapsed))
+    os.chdir(tempfile.mkdtemp())
+    encoder = base.JSON_ENCODER
+    for name in ('json', 'orjson'):
+        base.JSON_ENCODER = name
+        start = time.perf_counter()
+        User.save_to_file()
+        elapsed = time.perf_counter() - start
+        print("save {:<6} {:>6.2f} s {:>10.0f} users/s".format(
+            name if name == 'json' or base.orjson else name + '*',
+            elapsed, count / elapsed))
+    base.JSON_ENCODER = encoder
+
+
+def check_storage():
+    """ Run the same save, remove, get, count, all, search and
+    load_from_file checks against each storage backend
+    """
+    backend = base.STORAGE_BACKEND
+    for name in ('json', 'sqlite'):
+        os.chdir(tempfile.mkdtemp())
+        base.STORAGE_BACKEND = name
+        User.load_from_file()
+        assert User.count() == 0 and User.all() == []
+        bob = User(email="bob@hbtn.io", first_name="Bob")
+        bob.password = "pwd"
+        bob.save()
+        alice = User(email="alice@hbtn.io", first_name="Alice")
+        alice.save()
+        UserSession(user_id=bob.id, session_id="s1").save()
+        User.load_from_file()
+        assert User.count() == 2
+        got = User.get(bob.id)
+        assert got == bob and got.to_json(True) == bob.to_json(True)
+        assert got.is_valid_password("pwd") and User.get("nope") is None
+        assert User.search({'email': "alice@hbtn.io"}) == [alice]
+        assert User.search({'first_name': "Bob", 'last_name': None}) == [bob]
+        created_at = User.get(alice.id).created_at
+        assert alice in User.search({'created_at': created_at})
+        assert User.search({'password': bob.password}) == [bob]
+        assert sorted(u.id for u in User.all()) == sorted([bob.id, alice.id])
+        assert UserSession.search({'session_id': "s1"})[0].user_id == bob.id
+        alice.last_name = "Doe"
+        alice.save()
+        assert User.get(alice.id).last_name == "Doe"
+        bob.remove()
+        User.load_from_file()
+        assert User.count() == 1 and User.get(bob.id) is None
+        assert User.search({'email': "bob@hbtn.io"}) == []
+        print("{:<6} storage passes the shared checks".format(name))
+    base.STORAGE_BACKEND = backend
+
+
+def check_timestamps(samples: int = 200000):
+    """ Check that parse_timestamp and format_timestamp agree with
+    strptime and strftime on random datetimes, years below 1000 and
+    malformed or lenient strings
+    """
+    def outcome(func, value):
+        try:
+            return func(value)
+        except ValueError:
+            return ValueError
+
+    def strftime_timestamp(value):
+        return value.strftime(base.TIMESTAMP_FORMAT)
+
+    rng = random.Random(0)
+    values = []
+    for i in range(samples):
+        value = datetime(rng.randint(1, 9999) if i % 10 else
+                         rng.randint(1, 999), rng.randint(1, 12),
+                         rng.randint(1, 28), rng.randint(0, 23),
+                         rng.randint(0, 59), rng.randint(0, 59),
+                         rng.randint(0, 999999))
+        text = outcome(strftime_timestamp, value)
+        assert base.format_timestamp(value) == text, value
+        values.append(text)
+    values.extend([
+        "", "garbage", "2023-06-01", "2023-06-01 15:22:46",
+        "2023-6-1T1:2:3", "2023-06-01T15:22:46.123456",
+        "2023-06-01T15:22:46Z", "2023-06-01T15:22:46+00:00",
+        "2023-06-01T24:00:00", "2023-02-30T00:00:00", "0999-01-01T00:00:00",
+        "999-01-01T00:00:00", "20230601T152246", "2023-06-01T15:22:4 ",
+        " 2023-06-01T15:22:4", "2023-06-01t15:22:46", "2023/06/01T15:22:46",
+        "２０２３-06-01T15:22:46", "2023-06-01T15:2246:", "+2023-06-01T15:22",
+    ])
+    for value in values:
+        assert outcome(base.parse_timestamp, value) == \
+            outcome(strptime_timestamp, value), value
+    print("timestamps agree with strptime/strftime on {} values".format(
+        len(values)))
+
+
+def check_journal():
+    """ Check that the journal replays to the same objects, that a
+    torn last entry is dropped and compacted, and that a crash between
+    writing a snapshot and removing the journal replays the same
+    """
+    mode = base.STORAGE_MODE
+    base.STORAGE_MODE = 'journal'
+    os.chdir(tempfile.mkdtemp())
+    User.load_from_file()
+    users = [User(email="user{}@hbtn.io".format(i)) for i in range(10)]
+    for user in users:
+        user.save()
+    users[3].first_name = "Bob"
+    users[3].save()
+    for user in users[5:8]:
+        user.remove()
+
+    def state():
+        return {k: v.to_json(True) for k, v in base.DATA['User'].items()}
+
+    expected = state()
+    User.load_from_file()
+    assert state() == expected, "journal replay differs"
+
+    with open(".db_User.journal", 'a') as f:
+        f.write('{"op": "save", "id": "torn", "obj": {"em')
+    User.load_from_file()
+    assert state() == expected, "torn entry not dropped"
+    assert not os.path.exists(".db_User.journal"), "torn entry not compacted"
+
+    users[0].last_name = "Doe"
+    users[0].save()
+    users[1].remove()
+    expected = state()
+    with open(".db_User.journal", 'rb') as f:
+        journal = f.read()
+    User.save_to_file()
+    with open(".db_User.journal", 'wb') as f:
+        f.write(journal)
+    User.load_from_file()
+    assert state() == expected, "snapshot and stale journal replay differs"
+    base.STORAGE_MODE = mode
+    print("journal replay passes the crash checks")
+
+
+def bench_storage(count: int, lookups: int = 1000):
+    """ Compare startup, get, indexed search and save of the JSON
+    and SQLite backends with count users stored
+    """
+    backend = base.STORAGE_BACKEND
+    for name in ('json', 'sqlite'):
+        os.chdir(tempfile.mkdtemp())
+        base.STORAGE_BACKEND = name
+        populate(count)
+        users = list(base.DATA['User'].values())
+        if name == 'json':
+            User.save_to_file()
+        else:
+            storage = User.storage()
+            with storage.connection() as db:
+                db.executemany(storage.insert, (
+                    [user.to_json(True).get(c) for c in storage.columns]
+                    for user in users))
+        start = time.perf_counter()
+        User.load_from_file()
+        startup = time.perf_counter() - start
+        step = max(count // lookups, 1)
+        sample = users[::step][:lookups]
+        get = timeit.timeit(lambda: [User.get(u.id) for u in sample],
+                            number=1) / len(sample)
+        search = timeit.timeit(
+            lambda: [User.search({'email': u.email}) for u in sample],
+            number=1) / len(sample)
+        save = timeit.timeit(
+            lambda: [User(email="new{}".format(i)).save() for i in range(20)],
+            number=1) / 20
+        print("{:<6} startup {:>7.3f} s get {:>7.1f} us search {:>7.1f} us"
+              " save {:>9.1f} us".format(name, startup, get * 1e6,
+                                         search * 1e6, save * 1e6))
+    base.STORAGE_BACKEND = backend
+
+
+def bench_threads(count: int, threads: int = 8, seconds: float = 2.0):
+    """ Hammer search, save and remove from many threads in each
+    storage mode, then check that the file holds every object
+    """
+    for mode in ('file', 'journal', 'write_behind'):
+        os.chdir(tempfile.mkdtemp())
+        base.STORAGE_MODE = mode
+        populate(count)
+        User.save_to_file()
+        emails = [u.email for u in base.DATA['User'].values()]
+        stop = threading.Event()
+        reads = [0] * threads
+        writes = [0] * threads
+        errors = []
+
+        def worker(n):
+            rng = random.Random(n)
+            mine = []
+            try:
+                while not stop.is_set():
+                    op = rng.random()
+                    if op < 0.05:
+                        user = User(email="t{}-{}@hbtn.io".format(n, op))
+                        user.save()
+                        mine.append(user)
+                        writes[n] += 1
+                    elif op < 0.1 and len(mine) > 0:
+                        mine.pop(rng.randrange(len(mine))).remove()
+                        writes[n] += 1
+                    elif op < 0.11:
+                        User.search({'first_name': "Alice"})
+                        reads[n] += 1
+                    else:
+                        User.search({'email': rng.choice(emails)})
+                        reads[n] += 1
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=worker, args=(n, ))
+                   for n in range(threads)]
+        for thread in workers:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in workers:
+            thread.join()
+        base.flush()
+        expected = sorted(base.DATA['User'])
+        User.load_from_file()
+        consistent = sorted(base.DATA['User']) == expected
+        print("{:<12} {:>9.0f} reads/s {:>7.0f} writes/s errors {:>3}"
+              " file {}".format(mode, sum(reads) / seconds,
+                                sum(writes) / seconds, len(errors),
+                                "ok" if consistent else "MISMATCH"))
+    base.STORAGE_MODE = 'file'
+
+
+def process_worker(mode: str, directory: str, n: int, saves: int,
+                   barrier: multiprocessing.Barrier) -> tuple:
+    """ Save users from one process, then count the users of all
+    processes and look one up by email
+    """
+    os.chdir(directory)
+    base.STORAGE_MODE = mode
+    User.load_from_file()
+    barrier.wait()
+    for i in range(saves):
+        User(email="p{}-{}@hbtn.io".format(n, i)).save()
+    base.flush()
+    barrier.wait()
+    found = len(User.search({'email': "p0-{}@hbtn.io".format(saves - 1)}))
+    return User.count(), found
+
+
+def bench_processes(processes: int = 4, saves: int = 200):
+    """ Save users from several processes sharing the same files
+    and check that every process sees all of them
+    """
+    for mode in ('file', 'journal', 'write_behind'):
+        directory = tempfile.mkdtemp()
+        barrier = multiprocessing.Manager().Barrier(processes)
+        start = time.perf_counter()
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(process_worker, [
+                (mode, directory, n, saves, barrier)
+                for n in range(processes)])
+        elapsed = time.perf_counter() - start
+        os.chdir(directory)
+        base.STORAGE_MODE = mode
+        User.load_from_file()
+        expected = processes * saves
+        seen = all(r == (expected, 1) for r in results)
+        print("{:<12} {:>7.0f} saves/s stored {}/{} all processes see all:"
+              " {}".format(mode, expected / elapsed, User.count(), expected,
+                           seen))
+    base.STORAGE_MODE = 'file'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000000)
+    args = parser.parse_args()
+    check_storage()
+    check_journal()
+    check_timestamps()
+    bench_search(args.users)
+    bench_writes(min(args.users, 100000))
+    bench_memory(args.users)
+    bench_load(args.users)
+    bench_serialize(args.users)
+    bench_storage(min(args.users, 100000))
+    bench_threads(min(args.users, 10000))
+    bench_processes()
+    bench_users_endpoint(args.users)
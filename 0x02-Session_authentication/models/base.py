@@ -1,37 +1,466 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from contextlib import contextmanager
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from operator import attrgetter
+from threading import Condition, Event, Lock, RLock, Thread, get_ident, local
+from typing import Callable, TypeVar, List, Iterable
+from os import getenv, path
+import atexit
 import json
+import os
+import sqlite3
+import time
+import traceback
 import uuid
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+STORAGE_BACKEND = getenv('STORAGE_BACKEND', 'json')
+STORAGE_MODE = getenv('STORAGE_MODE', 'file')
+SQLITE_PATH = getenv('SQLITE_PATH', '.db.sqlite3')
+JOURNAL_LIMIT = int(getenv('JOURNAL_LIMIT', '1000'))
+FLUSH_INTERVAL = float(getenv('FLUSH_INTERVAL', '1.0'))
+FLUSH_CHANGES = int(getenv('FLUSH_CHANGES', '100'))
+JSON_ENCODER = getenv('JSON_ENCODER', 'json')
+REFRESH_INTERVAL = float(getenv('REFRESH_INTERVAL', '0'))
 DATA = {}
+INDEXES = {}
+JOURNALS = {}
+DIRTY = {}
+PENDING = {}
+WRITES = {}
+STORAGES = {}
+SEEN = {}
+CHECKED = {}
+LOCKS = {}
+flush_lock = Lock()
+file_lock = RLock()
+flush_event = Event()
+flusher = []
+connections = local()
+
+
+def parse_timestamp(value: str) -> datetime:
+    """ Parse a TIMESTAMP_FORMAT string
+    The fixed YYYY-MM-DDTHH:MM:SS layout is parsed by
+    datetime.fromisoformat, anything else by strptime
+    """
+    if len(value) == 19 and value.isascii() \
+            and value[4] + value[7] + value[10] + value[13] + value[16] \
+            == '--T::':
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def format_timestamp(value: datetime) -> str:
+    """ Format a datetime with TIMESTAMP_FORMAT
+    """
+    if value.tzinfo is None and value.year >= 1000:
+        return value.isoformat('T', 'seconds')
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def json_dumps(obj, sort_keys=False, separators=None) -> str:
+    """ Encode an object to JSON with JSON_ENCODER,
+    falling back to the json module if orjson is not installed
+    (orjson output is always compact)
+    """
+    if JSON_ENCODER == 'orjson' and orjson is not None:
+        option = orjson.OPT_SORT_KEYS if sort_keys else 0
+        return orjson.dumps(obj, option=option).decode('utf-8')
+    return json.dumps(obj, sort_keys=sort_keys, separators=separators)
+
+
+def flush():
+    """ Write every class with pending changes to its file
+    Classes whose write fails stay pending, and the first error
+    is raised once the other classes are written
+    """
+    with flush_lock:
+        dirty = [(cls, changes, PENDING.pop(cls, {}))
+                 for cls, changes in DIRTY.items()]
+        DIRTY.clear()
+    error = None
+    for cls, changes, pending in dirty:
+        try:
+            cls.write_pending(pending)
+        except Exception as e:
+            with flush_lock:
+                DIRTY[cls] = DIRTY.get(cls, 0) + changes
+                newer = PENDING.setdefault(cls, {})
+                for obj_id, obj in pending.items():
+                    newer.setdefault(obj_id, obj)
+            error = error or e
+            continue
+        with flush_lock:
+            stats = WRITES.setdefault(cls.__name__, {
+                'changes': 0, 'writes': 0, 'coalesced': 0,
+            })
+            stats['writes'] += 1
+            stats['coalesced'] += changes - 1
+    if error is not None:
+        raise error
+
+
+def write_stats() -> dict:
+    """ Return the changes, file writes and coalesced writes
+    of each class in write-behind mode
+    """
+    with flush_lock:
+        return {s_class: dict(stats) for s_class, stats in WRITES.items()}
+
+
+def flush_loop():
+    """ Flush pending changes at most once per interval, or sooner
+    when a class gathers enough changes
+    Failed writes are reported and retried at the next interval
+    """
+    while True:
+        flush_event.wait(FLUSH_INTERVAL)
+        flush_event.clear()
+        try:
+            flush()
+        except Exception:
+            traceback.print_exc()
+
+
+def mark_dirty(cls: type, op: str, obj: TypeVar('Base')):
+    """ Record a change to be written by the background flusher
+    """
+    with flush_lock:
+        DIRTY[cls] = DIRTY.get(cls, 0) + 1
+        PENDING.setdefault(cls, {})[obj.id] = obj if op == 'save' else None
+        stats = WRITES.setdefault(cls.__name__, {
+            'changes': 0, 'writes': 0, 'coalesced': 0,
+        })
+        stats['changes'] += 1
+        if DIRTY[cls] >= FLUSH_CHANGES:
+            flush_event.set()
+        if len(flusher) == 0:
+            flusher.append(Thread(target=flush_loop, daemon=True))
+            flusher[0].start()
+            atexit.register(flush)
+
+
+@contextmanager
+def lock_files(s_class: str):
+    """ Hold the lock of a class's files against other processes
+    (with fcntl, where available) and other threads
+    The lock is reentrant within a process
+    """
+    with file_lock:
+        held = LOCKS.get(s_class)
+        if held is None:
+            f = open(".db_{}.lock".format(s_class), 'a')
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            held = LOCKS[s_class] = [f, 0]
+        held[1] += 1
+        try:
+            yield
+        finally:
+            held[1] -= 1
+            if held[1] == 0:
+                del LOCKS[s_class]
+                held[0].close()
+
+
+def file_state(s_class: str) -> tuple:
+    """ Return the (inode, mtime, size) of the file and the
+    (inode, size) of the journal of a class, None if missing
+    """
+    try:
+        st = os.stat(".db_{}.json".format(s_class))
+        snapshot = (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        snapshot = None
+    try:
+        st = os.stat(".db_{}.journal".format(s_class))
+        journal = (st.st_ino, st.st_size)
+    except FileNotFoundError:
+        journal = None
+    return snapshot, journal
+
+
+class Guard():
+    """ Context manager calling an acquire and a release function
+    """
+
+    def __init__(self, acquire: Callable, release: Callable):
+        """ Initialize with the functions to call
+        """
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        """ Acquire
+        """
+        self.acquire()
+
+    def __exit__(self, *args: list):
+        """ Release
+        """
+        self.release()
+
+
+class RWLock():
+    """ Lock allowing many readers or one writer
+    Waiting writers go before new readers, and the writer may take
+    the lock again, for reading or writing, while holding it
+    """
+
+    def __init__(self):
+        """ Initialize an unlocked lock
+        """
+        self.mutex = Lock()
+        self.condition = Condition(self.mutex)
+        self.readers = 0
+        self.waiting = 0
+        self.writer = None
+        self.depth = 0
+        self.reading = Guard(self.acquire_read, self.release_read)
+        self.writing = Guard(self.acquire_write, self.release_write)
+
+    def read(self) -> Guard:
+        """ Return a context manager holding the lock for reading
+        """
+        return self.reading
+
+    def write(self) -> Guard:
+        """ Return a context manager holding the lock for writing
+        """
+        return self.writing
+
+    def acquire_read(self):
+        """ Wait for the lock to be free of writers and hold it
+        for reading
+        """
+        if self.writer == get_ident():
+            self.depth += 1
+            return
+        with self.mutex:
+            while self.writer is not None or self.waiting > 0:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        """ Stop holding the lock for reading
+        """
+        if self.writer == get_ident():
+            self.depth -= 1
+            return
+        with self.mutex:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        """ Wait for the lock to be free and hold it for writing
+        """
+        me = get_ident()
+        with self.mutex:
+            if self.writer != me:
+                self.waiting += 1
+                while self.writer is not None or self.readers > 0:
+                    self.condition.wait()
+                self.waiting -= 1
+                self.writer = me
+            self.depth += 1
+
+    def release_write(self):
+        """ Stop holding the lock for writing
+        """
+        with self.mutex:
+            self.depth -= 1
+            if self.depth == 0:
+                self.writer = None
+                self.condition.notify_all()
+
+
+store_lock = RWLock()
+
+
+class Index():
+    """ Hash index of objects by attribute values
+    """
+
+    def __init__(self, attributes: Iterable[str]):
+        """ Initialize an empty index on attributes
+        """
+        self.attributes = tuple(attributes)
+        self.buckets = {attr: {} for attr in self.attributes}
+        self.values = {}
+
+    def add(self, obj: TypeVar('Base')):
+        """ Index an object under its current attribute values
+        """
+        self.discard(obj.id)
+        values = {}
+        for attr in self.attributes:
+            value = getattr(obj, attr, None)
+            try:
+                self.buckets[attr].setdefault(value, {})[obj.id] = obj
+            except TypeError:
+                continue
+            values[attr] = value
+        self.values[obj.id] = values
+
+    def discard(self, obj_id: str):
+        """ Remove an object from the index
+        """
+        values = self.values.pop(obj_id, {})
+        for attr, value in values.items():
+            bucket = self.buckets[attr].get(value)
+            if bucket is None:
+                continue
+            bucket.pop(obj_id, None)
+            if len(bucket) == 0:
+                del self.buckets[attr][value]
+
+    def lookup(self, attr: str, value) -> List[TypeVar('Base')]:
+        """ Return the objects indexed under a value,
+        or None if the value can't be indexed
+        """
+        try:
+            return list(self.buckets[attr].get(value, {}).values())
+        except TypeError:
+            return None
+
+
+class SQLiteStorage():
+    """ Objects of a class stored in a SQLite table, one column
+    per slot, with an index on each indexed attribute
+    Objects are read on demand: get and search return new objects
+    """
+
+    def __init__(self, cls: type, file_path: str):
+        """ Create the table of a class if needed
+        """
+        self.cls = cls
+        self.file_path = path.abspath(file_path)
+        self.columns = tuple(cls.slot_names())
+        self.table = '"{}"'.format(cls.__name__)
+        names = ', '.join('"{}"'.format(c) for c in self.columns)
+        self.insert = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+            self.table, names, ', '.join('?' * len(self.columns)))
+        db = self.connection()
+        db.execute('CREATE TABLE IF NOT EXISTS {} ("id" TEXT PRIMARY KEY)'
+                   .format(self.table))
+        existing = [row[1] for row in db.execute(
+            'PRAGMA table_info({})'.format(self.table))]
+        for column in self.columns:
+            if column not in existing:
+                db.execute('ALTER TABLE {} ADD COLUMN "{}"'.format(
+                    self.table, column))
+        for attr in cls.indexes:
+            db.execute('CREATE INDEX IF NOT EXISTS "{}_{}" ON {} ("{}")'
+                       .format(cls.__name__, attr, self.table, attr))
+
+    def connection(self) -> sqlite3.Connection:
+        """ Return the connection of the current thread to the file
+        """
+        dbs = connections.__dict__.setdefault('dbs', {})
+        db = dbs.get(self.file_path)
+        if db is None:
+            db = sqlite3.connect(self.file_path, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            dbs[self.file_path] = db
+        return db
+
+    def load(self, row: sqlite3.Row) -> TypeVar('Base'):
+        """ Build an object from a row
+        """
+        return self.cls(**dict(zip(row.keys(), row)))
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or replace an object
+        """
+        obj_json = self.cls.serializer(True)(obj)
+        self.connection().execute(
+            self.insert, [obj_json.get(c) for c in self.columns])
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object
+        """
+        self.connection().execute(
+            'DELETE FROM {} WHERE "id" = ?'.format(self.table), (obj.id, ))
+
+    def count(self) -> int:
+        """ Count the rows
+        """
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+
+    def get(self, id: str) -> TypeVar('Base'):
+        """ Return one object by ID, or None
+        """
+        row = self.connection().execute(
+            'SELECT * FROM {} WHERE "id" = ?'.format(self.table),
+            (id, )).fetchone()
+        return None if row is None else self.load(row)
+
+    def search(self, attributes: dict) -> List[TypeVar('Base')]:
+        """ Return the objects with matching attributes
+        Attributes stored in columns are matched by SQLite, others
+        (such as properties) on the loaded objects
+        """
+        where = []
+        params = []
+        others = {}
+        for k, v in attributes.items():
+            if k not in self.columns:
+                others[k] = v
+                continue
+            where.append('"{}" IS ?'.format(k))
+            params.append(format_timestamp(v) if type(v) is datetime else v)
+        query = 'SELECT * FROM {}'.format(self.table)
+        if len(where) > 0:
+            query += ' WHERE ' + ' AND '.join(where)
+        objs = [self.load(row)
+                for row in self.connection().execute(query, params)]
+        return [obj for obj in objs
+                if all(getattr(obj, k) == v for k, v in others.items())]
 
 
 class Base():
     """ Base class
+    Attributes are stored in slots: subclasses declare theirs
+    in __slots__ and objects have no per-instance __dict__
     """
 
+    __slots__ = ('id', 'created_at', 'updated_at')
+    indexes = ()
+    timestamps = ('created_at', 'updated_at')
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
         s_class = str(self.__class__.__name__)
-        if DATA.get(s_class) is None:
-            DATA[s_class] = {}
+        if DATA.get(s_class) is None or INDEXES.get(s_class) is None:
+            with store_lock.write():
+                DATA.setdefault(s_class, {})
+                INDEXES.setdefault(s_class, Index(self.__class__.indexes))
 
         self.id = kwargs.get('id', str(uuid.uuid4()))
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self.created_at = parse_timestamp(kwargs.get('created_at'))
         else:
             self.created_at = datetime.utcnow()
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self.updated_at = parse_timestamp(kwargs.get('updated_at'))
         else:
             self.updated_at = datetime.utcnow()
 
@@ -47,66 +476,312 @@ class Base():
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
+        return self.__class__.serializer(for_serialization)(self)
+
+    def to_json_slow(self, for_serialization: bool = False) -> dict:
+        """ Convert the object a JSON dictionary attribute by
+        attribute, skipping the ones not set
+        """
         result = {}
-        for key, value in self.__dict__.items():
+        for key, value in self.attributes():
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
+                result[key] = format_timestamp(value)
             else:
                 result[key] = value
         return result
 
+    @classmethod
+    def serializer(cls, for_serialization: bool = False) -> Callable:
+        """ Return the to_json function of the class, compiled once
+        Timestamps are formatted without looking up their type,
+        other attributes only if they hold a datetime; objects with
+        attributes not set or timestamps not datetimes fall back
+        to to_json_slow
+        """
+        key = '_serializer' if for_serialization else '_json_serializer'
+        func = cls.__dict__.get(key)
+        if func is not None:
+            return func
+        names = tuple(name for name in cls.slot_names()
+                      if for_serialization or name[0] != '_')
+        timestamps = tuple(name for name in names if name in cls.timestamps)
+        others = tuple(name for name in names if name not in timestamps)
+        # the extra name makes attrgetter always return a tuple
+        getter = attrgetter(*names, names[0])
+
+        def func(obj: TypeVar('Base')) -> dict:
+            try:
+                result = dict(zip(names, getter(obj)))
+                for name in timestamps:
+                    result[name] = format_timestamp(result[name])
+            except AttributeError:
+                return obj.to_json_slow(for_serialization)
+            for name in others:
+                if type(result[name]) is datetime:
+                    result[name] = format_timestamp(result[name])
+            return result
+
+        setattr(cls, key, func)
+        return func
+
+    @classmethod
+    def slot_names(cls) -> List[str]:
+        """ Return the slots of the class and its parents,
+        in declaration order
+        """
+        names = cls.__dict__.get('_slot_names')
+        if names is None:
+            names = []
+            for klass in reversed(cls.__mro__):
+                for name in klass.__dict__.get('__slots__', ()):
+                    if name not in names:
+                        names.append(name)
+            cls._slot_names = names
+        return names
+
+    def attributes(self) -> Iterable[tuple]:
+        """ Return the (name, value) pairs of the attributes set
+        on the object
+        """
+        for name in self.__class__.slot_names():
+            try:
+                yield name, getattr(self, name)
+            except AttributeError:
+                continue
+
+    @classmethod
+    def storage(cls) -> SQLiteStorage:
+        """ Return the SQLite storage of the class when STORAGE_BACKEND
+        is sqlite, or None for the JSON files
+        """
+        if STORAGE_BACKEND != 'sqlite':
+            return None
+        storage = STORAGES.get(cls)
+        if storage is None or storage.file_path != path.abspath(SQLITE_PATH):
+            storage = SQLiteStorage(cls, SQLITE_PATH)
+            STORAGES[cls] = storage
+        return storage
+
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from file, then replay the journal
+        With SQLite, only the table is created: objects are
+        read when needed
         """
         s_class = cls.__name__
+        if cls.storage() is not None:
+            return
         file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
+        with lock_files(s_class), store_lock.write():
+            DATA[s_class] = {}
+            INDEXES[s_class] = Index(cls.indexes)
+            JOURNALS[s_class] = 0
+            if path.exists(file_path):
+                with open(file_path, 'r') as f:
+                    objs_json = json.load(f)
+                    for obj_id, obj_json in objs_json.items():
+                        DATA[s_class][obj_id] = cls(**obj_json)
+                        INDEXES[s_class].add(DATA[s_class][obj_id])
+            cls.replay_journal()
+            SEEN[s_class] = file_state(s_class)
+
+    @classmethod
+    def refresh(cls, force: bool = True):
+        """ Catch up with changes written by other processes since
+        the class was loaded or last written by this one
+        Journal entries appended since are replayed; a new snapshot
+        or journal is loaded in full
+        Unless forced, files are checked at most once per
+        REFRESH_INTERVAL seconds
+        Skipped while write-behind changes are pending, since loading
+        would drop them: flush merges them instead
+        """
+        s_class = cls.__name__
+        seen = SEEN.get(s_class)
+        if seen is None or cls in DIRTY:
             return
+        if not force and REFRESH_INTERVAL > 0:
+            now = time.monotonic()
+            if now - CHECKED.get(s_class, 0) < REFRESH_INTERVAL:
+                return
+            CHECKED[s_class] = now
+        if seen == file_state(s_class):
+            return
+        cls.reload_changes()
+
+    @classmethod
+    def reload_changes(cls):
+        """ Load the changes written to the files since they were
+        last seen, holding their lock
+        """
+        s_class = cls.__name__
+        with lock_files(s_class):
+            state = file_state(s_class)
+            seen = SEEN.get(s_class)
+            if seen is None or seen == state:
+                return
+            if seen[0] != state[0] or seen[1] is None or state[1] is None \
+                    or seen[1][0] != state[1][0]:
+                cls.load_from_file()
+                return
+            with store_lock.write():
+                cls.replay_journal(seen[1][1])
+            SEEN[s_class] = file_state(s_class)
+
+    @classmethod
+    def write_pending(cls, pending: dict):
+        """ Write write-behind changes, given as objects (None when
+        removed) by ID, over the changes of other processes
+        Changes made since the flush started are kept too
+        """
+        s_class = cls.__name__
+        with lock_files(s_class):
+            cls.reload_changes()
+            pending = dict(pending)
+            with flush_lock:
+                pending.update(PENDING.get(cls, {}))
+            with store_lock.write():
+                for obj_id, obj in pending.items():
+                    INDEXES[s_class].discard(obj_id)
+                    if obj is None:
+                        DATA[s_class].pop(obj_id, None)
+                        continue
+                    DATA[s_class][obj_id] = obj
+                    INDEXES[s_class].add(obj)
+            cls.save_to_file()
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def replay_journal(cls, offset: int = 0):
+        """ Apply the journal entries written since the last snapshot,
+        starting at a byte offset
+        A torn entry at the end, left by a crash, is dropped by
+        compacting the journal right away
+        """
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        if not path.exists(journal_path):
+            return
+        torn = False
+        with open(journal_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    torn = True
+                    break
+                JOURNALS[s_class] += 1
+                obj_id = entry['id']
+                INDEXES[s_class].discard(obj_id)
+                if entry['op'] == 'remove':
+                    DATA[s_class].pop(obj_id, None)
+                    continue
+                DATA[s_class][obj_id] = cls(**entry['obj'])
+                INDEXES[s_class].add(DATA[s_class][obj_id])
+        if torn or JOURNALS[s_class] > max(JOURNAL_LIMIT, len(DATA[s_class])):
+            cls.save_to_file()
 
     @classmethod
     def save_to_file(cls):
-        """ Save all objects to file
+        """ Save all objects to file and empty the journal
+        The snapshot replaces the previous one atomically
         """
         s_class = cls.__name__
         file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        serializer = cls.serializer(True)
+        with lock_files(s_class):
+            with store_lock.read():
+                objs = list(DATA[s_class].items())
+            objs_json = {}
+            for obj_id, obj in objs:
+                objs_json[obj_id] = serializer(obj)
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+            tmp_path = "{}.tmp".format(file_path)
+            with open(tmp_path, 'w') as f:
+                f.write(json_dumps(objs_json))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+            journal_path = ".db_{}.journal".format(s_class)
+            if path.exists(journal_path):
+                os.remove(journal_path)
+            JOURNALS[s_class] = 0
+            SEEN[s_class] = file_state(s_class)
+
+    @classmethod
+    def append_to_journal(cls, op: str, obj: TypeVar('Base')):
+        """ Append a save or remove entry to the journal,
+        compacting it into a snapshot when it grows too large
+        """
+        s_class = cls.__name__
+        entry = {'op': op, 'id': obj.id}
+        if op == 'save':
+            entry['obj'] = obj.to_json(True)
+        journal_path = ".db_{}.journal".format(s_class)
+        with lock_files(s_class):
+            with open(journal_path, 'a') as f:
+                f.write(json_dumps(entry) + '\n')
+            SEEN[s_class] = file_state(s_class)
+            JOURNALS[s_class] = JOURNALS.get(s_class, 0) + 1
+            if JOURNALS[s_class] > max(JOURNAL_LIMIT, len(DATA[s_class])):
+                cls.save_to_file()
+
+    @classmethod
+    def persist(cls, op: str, obj: TypeVar('Base')):
+        """ Persist a change to an object in the storage mode
+        """
+        if STORAGE_MODE == 'journal':
+            cls.append_to_journal(op, obj)
+        elif STORAGE_MODE == 'write_behind':
+            mark_dirty(cls, op, obj)
+        else:
+            cls.save_to_file()
 
     def save(self):
         """ Save current object
+        Changes of other processes are loaded first, unless
+        write-behind changes are pending, so they are not overwritten
         """
         s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        storage = self.__class__.storage()
+        if storage is not None:
+            return storage.save(self)
+        with lock_files(s_class):
+            self.__class__.refresh()
+            with store_lock.write():
+                DATA[s_class][self.id] = self
+                INDEXES[s_class].add(self)
+            self.__class__.persist('save', self)
 
     def remove(self):
         """ Remove object
         """
         s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        storage = self.__class__.storage()
+        if storage is not None:
+            return storage.remove(self)
+        with lock_files(s_class):
+            self.__class__.refresh()
+            with store_lock.write():
+                removed = DATA[s_class].pop(self.id, None) is not None
+                INDEXES[s_class].discard(self.id)
+            if removed:
+                self.__class__.persist('remove', self)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
         s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        storage = cls.storage()
+        if storage is not None:
+            return storage.count()
+        cls.refresh(False)
+        with store_lock.read():
+            return len(DATA[s_class])
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -119,13 +794,24 @@ class Base():
         """ Return one object by ID
         """
         s_class = cls.__name__
-        return DATA[s_class].get(id)
+        storage = cls.storage()
+        if storage is not None:
+            return storage.get(id)
+        cls.refresh(False)
+        with store_lock.read():
+            return DATA[s_class].get(id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
+        Indexed attributes are looked up in the class index,
+        which reflects the objects as they were last saved
         """
         s_class = cls.__name__
+        storage = cls.storage()
+        if storage is not None:
+            return storage.search(attributes)
+        cls.refresh(False)
         def _search(obj):
             if len(attributes) == 0:
                 return True
@@ -133,5 +819,14 @@ class Base():
                 if (getattr(obj, k) != v):
                     return False
             return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+
+        with store_lock.read():
+            objs = None
+            for k, v in attributes.items():
+                if k in cls.indexes:
+                    objs = INDEXES[s_class].lookup(k, v)
+                if objs is not None:
+                    break
+            if objs is None:
+                objs = DATA[s_class].values()
+            return list(filter(_search, objs))
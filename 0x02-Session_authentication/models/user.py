@@ -9,6 +9,9 @@ class User(Base):
     """ User class
     """
 
+    __slots__ = ('email', '_password', 'first_name', 'last_name')
+    indexes = ('email',)
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance
         """
@@ -8,6 +8,9 @@ class UserSession(Base):
     """User session class.
     """
 
+    __slots__ = ('user_id', 'session_id')
+    indexes = ('session_id',)
+
     def __init__(self, *args: list, **kwargs: dict):
         """Initializes a User session instance.
         """